@@ -3,8 +3,8 @@
 import argparse
 import asyncio
 import boto3
-import os
-import psycopg
+import threading
+import time
 from psycopg import sql, AsyncConnection
 
 # Create the argument parser
@@ -20,15 +20,42 @@ parser.add_argument("--schema", required=True, help="Schema name")
 # Parse the arguments
 args = parser.parse_args()
 
+TOKEN_EXPIRES_IN = 900  # Lifetime of a generated IAM authentication token (in seconds)
+TOKEN_REFRESH_MARGIN = 60  # Generate a new token this long before the cached one expires (in seconds)
+
+
+class _TokenCache:
+    """Reuse one IAM authentication token across connections until shortly before it expires."""
+
+    def __init__(self):
+        self.client = None
+        self.token = None
+        self.expiry = 0.0  # time.monotonic() value at which the token expires
+        self.lock = threading.Lock()  # Tokens are generated from worker threads
+
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.expiry - TOKEN_REFRESH_MARGIN:
+                if self.client is None:
+                    self.client = boto3.client("dsql", region_name=args.region)
+                self.expiry = time.monotonic() + TOKEN_EXPIRES_IN
+                self.token = self.client.generate_db_connect_admin_auth_token(args.host, args.region, TOKEN_EXPIRES_IN)
+            return self.token
+
+_token_cache = _TokenCache()
+
+def get_token():
+    """Return a valid IAM authentication token, generating a new one only when the cached one is about to expire."""
+    return _token_cache.get_token()
+
 
 async def connect_to_database():
     """
-    Connect to the PostgreSQL database using an inline IAM token generation.
+    Connect to the PostgreSQL database using a cached IAM token.
     :return: psycopg.AsyncConnection
     """
-    # Generate the IAM authentication token inline
-    client = boto3.client("dsql", region_name=args.region)
-    password_token = client.generate_db_connect_admin_auth_token(args.host, args.region)
+    # Reuse the cached IAM token; signing a new one runs in a worker thread so it doesn't block the event loop
+    password_token = await asyncio.to_thread(get_token)
 
     # Connect to the PostgreSQL database using the generated token
     conn = await AsyncConnection.connect(
@@ -52,37 +79,37 @@ async def create_tables():
     except Exception as e:
         print(f"An error occurred while creating the schema: {e}")
 
-    async with conn.cursor() as cur:
-        # SQL command to create 'orders' table
-        create_orders_table_query = sql.SQL("""
-            CREATE TABLE IF NOT EXISTS {}.orders (
-                order_id int PRIMARY KEY,
-                customer_id INTEGER NOT NULL,
-                order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_amount NUMERIC(10, 2)
-            )
-        """).format(sql.Identifier(args.schema))
-
-        # SQL command to create 'accounts' table
-        create_accounts_table_query = sql.SQL("""
-            CREATE TABLE IF NOT EXISTS {}.accounts (
-                account_id int PRIMARY KEY,
-                account_name VARCHAR(100),
-                email VARCHAR(100) UNIQUE NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """).format(sql.Identifier(args.schema))
-
-        # Execute the queries to create the tables
-        try:
-            await cur.execute(create_orders_table_query)
-        except Exception as e:
-            print(f"An error occurred while creating the 'orders' table: {e}")
-
-        try:
-            await cur.execute(create_accounts_table_query)
-        except Exception as e:
-            print(f"An error occurred while creating the 'accounts' table: {e}")
+    # SQL command to create 'orders' table
+    create_orders_table_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {}.orders (
+            order_id int PRIMARY KEY,
+            customer_id INTEGER NOT NULL,
+            order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_amount NUMERIC(10, 2)
+        )
+    """).format(sql.Identifier(args.schema))
+
+    # SQL command to create 'accounts' table
+    create_accounts_table_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {}.accounts (
+            account_id int PRIMARY KEY,
+            account_name VARCHAR(100),
+            email VARCHAR(100) UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """).format(sql.Identifier(args.schema))
+
+    # Execute the queries to create the tables. Aurora DSQL allows only one DDL statement per transaction, so each
+    # one is sent on its own in autocommit mode rather than batched into a single pipelined (implicit) transaction
+    try:
+        await conn.execute(create_orders_table_query)
+    except Exception as e:
+        print(f"An error occurred while creating the 'orders' table: {e}")
+
+    try:
+        await conn.execute(create_accounts_table_query)
+    except Exception as e:
+        print(f"An error occurred while creating the 'accounts' table: {e}")
 
     # Close the connection
     await conn.close()
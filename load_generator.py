@@ -5,36 +5,79 @@
 # Copyright 2024 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 
 import boto3
-import psycopg
-from psycopg import sql, AsyncConnection
-import psycopg.sql as sql
+from psycopg import sql, AsyncRawCursor
+from psycopg import errors as pgerr
+from psycopg.types.numeric import Int4BinaryDumper
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
 import argparse
 import asyncio
+import collections
+import contextlib
 import random
 import time
 import sys
-import secrets
+import threading
+import uvloop
 
 
-async def connect_to_database():
+TOKEN_EXPIRES_IN = 900  # Lifetime of a generated IAM authentication token (in seconds)
+TOKEN_REFRESH_MARGIN = 60  # Generate a new token this long before the cached one expires (in seconds)
+STATS_INTERVAL = 5  # How often the load test counters are printed (in seconds)
+MAX_QUERY_PARAMS = 65535  # Most parameters a single statement can take in the PostgreSQL wire protocol
+
+_stats = collections.Counter()  # Load test counters, printed periodically instead of a line per event
+
+
+class _TokenCache:
+    """Reuse one IAM authentication token across connections until shortly before it expires."""
+
+    def __init__(self):
+        self.client = None
+        self.token = None
+        self.expiry = 0.0  # time.monotonic() value at which the token expires
+        self.lock = threading.Lock()  # Tokens are generated from worker threads
+
+    def get_token(self):
+        with self.lock:
+            if self.token is None or time.monotonic() >= self.expiry - TOKEN_REFRESH_MARGIN:
+                if self.client is None:
+                    self.client = boto3.client("dsql", region_name=args.region)
+                self.expiry = time.monotonic() + TOKEN_EXPIRES_IN
+                self.token = self.client.generate_db_connect_admin_auth_token(args.host, args.region, TOKEN_EXPIRES_IN)
+            return self.token
+
+_token_cache = _TokenCache()
+
+def get_token():
+    """Return a valid IAM authentication token, generating a new one only when the cached one is about to expire."""
+    return _token_cache.get_token()
+
+async def connection_kwargs():
     """
-    Connect to the PostgreSQL database using an inline IAM token generation.
-    :return: psycopg.AsyncConnection
+    Build the connection arguments for a new pool connection, using a cached IAM token.
+    :return: dict
     """
-    # Generate the IAM authentication token inline
-    client = boto3.client("dsql", region_name=args.region)
-    password_token = client.generate_db_connect_admin_auth_token(args.host, args.region)
+    # Reuse the cached IAM token; signing a new one runs in a worker thread so it doesn't block the event loop
+    password_token = await asyncio.to_thread(get_token)
 
-    # Connect to the PostgreSQL database using the generated token
-    conn = await AsyncConnection.connect(
+    return dict(
         host=args.host,
         dbname=args.database,
         user=args.user,
         password=password_token,
         sslmode="require",
-        autocommit=True
+        # TCP keepalives detect dead connections and stop idle pooled ones from being dropped by intermediaries
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3
     )
-    return conn
+
+async def configure_connection(conn):
+    """Set up a new pool connection for loading."""
+    # Send every int as binary int4, like floats already are: no text formatting/parsing on either side, and
+    # fixed parameter types keep the prepared INSERT the same across batches
+    conn.adapters.register_dumper(int, Int4BinaryDumper)
 
 async def main():
     parse_args(sys.argv[1:])
@@ -47,29 +90,30 @@ class DataGenerator:
     def __init__(self, column_list):
         # Store column list with types
         self.column_list = column_list
-    
-    def generate_row(self):
-        # Generate a random row of data based on the expected column types
-        row = []
-        secure_random = random.SystemRandom()  # Use SystemRandom for cryptographically secure random generation
-
-        for column_name, column_type in self.column_list:
-            if column_type == 'integer':
-                row.append(secrets.randbelow(100000))  # Generate random integer using secrets
-            elif column_type == 'numeric' or column_type == 'float':
-                row.append(secure_random.random() * 1000)  # Generate random float securely
-            elif column_type == 'varchar' or column_type == 'text':
-                row.append(f"user_{secrets.randbelow(100000)}@test.com")  # Generate random email using secrets
-            else:
-                row.append(None)  # Default for unsupported types
-        return row
-
-    async def get_n_rows(self, n_rows):
-        """Generate `n_rows` of test data."""
-        rows = []
-        for _ in range(n_rows):
-            rows.append(self.generate_row())
-        return rows
+        # Column names and their quoted SQL form, computed once for building statements
+        self.column_names = tuple(col[0] for col in column_list)
+        self.column_identifiers = sql.SQL(', ').join(map(sql.Identifier, self.column_names))
+        # Test data doesn't need cryptographic randomness: one fast, non-crypto generator seeded once
+        self._rng = random.Random()
+        # Pick each column's value builder once, so generating a batch doesn't compare type names again
+        self._builders = [self._builder_for(column_type) for column_name, column_type in column_list]
+
+    def _builder_for(self, column_type):
+        """Return a function generating `n` random values for a column of `column_type`."""
+        rng = self._rng
+        if column_type == 'integer':
+            return lambda n: [rng.randrange(100000) for _ in range(n)]  # Generate random integers
+        elif column_type == 'numeric' or column_type == 'float':
+            return lambda n: [rng.random() * 1000 for _ in range(n)]  # Generate random floats
+        elif column_type == 'varchar' or column_type == 'text':
+            return lambda n: [f"user_{rng.randrange(100000)}@test.com" for _ in range(n)]  # Generate random emails
+        else:
+            return lambda n: [None] * n  # Default for unsupported types
+
+    def get_n_rows(self, n_rows):
+        """Generate `n_rows` of test data, one column at a time."""
+        # Build each column of the batch, then zip the columns into rows
+        return list(zip(*[build(n_rows) for build in self._builders]))
 
 async def get_table_columns(conn, schema, table_name):
     """Fetch the column names and their data types from the given table."""
@@ -87,69 +131,148 @@ async def get_table_columns(conn, schema, table_name):
 
         return column_list
 
+def build_insert_cmd(sfr, n_rows):
+    """Build an INSERT into the target table with one VALUES tuple per row, so a whole batch is a single statement."""
+    n_columns = len(sfr.column_names)
+
+    # Numbered $n placeholders, as used by a raw cursor: psycopg sends the query as is instead of scanning it
+    # for %s placeholders on every execute (it doesn't cache that work for statements this long)
+    placeholders = [sql.SQL(f"${i}") for i in range(1, n_rows * n_columns + 1)]
+    row_placeholders = [
+        sql.SQL("({})").format(sql.SQL(', ').join(placeholders[i:i + n_columns]))  # Placeholders for one row
+        for i in range(0, len(placeholders), n_columns)
+    ]
+
+    return sql.SQL("""
+        INSERT INTO {} ({}) 
+        VALUES {}
+        ON CONFLICT DO NOTHING
+    """).format(
+        sql.Identifier(args.schema, args.tablename),
+        sfr.column_identifiers,  # Column names
+        sql.SQL(', ').join(row_placeholders)  # One placeholder tuple per row
+    )
+
+def build_inserts(sfr, batchsize, conn):
+    """
+    Split a batch into INSERTs of at most MAX_QUERY_PARAMS parameters each, rendered for `conn`.
+    :return: list of (query, start, end): each query takes the flattened batch values params[start:end]
+    """
+    n_columns = len(sfr.column_names)
+    rows_per_insert = MAX_QUERY_PARAMS // n_columns
+
+    queries = {}  # Rendered INSERT by row count; a batch needs at most two: full-size and the remainder
+    inserts = []
+    for first_row in range(0, batchsize, rows_per_insert):
+        n_rows = min(rows_per_insert, batchsize - first_row)
+        if n_rows not in queries:
+            queries[n_rows] = build_insert_cmd(sfr, n_rows).as_bytes(conn)
+        inserts.append((queries[n_rows], first_row * n_columns, (first_row + n_rows) * n_columns))
+
+    return inserts
+
+def count_error(e, message):
+    """Count an error in the stats, printing `message` only the first time this error type is seen."""
+    key = 'err:' + type(e).__name__
+    _stats[key] += 1
+    if _stats[key] == 1:
+        print(message)
+
+async def _reporter():
+    """Print the load test counters every STATS_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        print(dict(_stats))
+
 async def load_test():
-    conn = await connect_to_database()
-    if not conn:
-        print("Failed to connect to the database. Exiting.")
-        return
+    # Open one connection per loader up front, instead of a connection + token + TLS handshake per task. The
+    # column lookup needs a connection even when no loader runs (--threads 0).
+    pool_size = max(args.threads, 1)
+    async with AsyncConnectionPool(
+        kwargs=connection_kwargs,
+        min_size=pool_size,
+        max_size=pool_size,
+        configure=configure_connection,
+        open=False
+    ) as pool:
+        try:
+            await pool.wait()
+        except PoolTimeout:
+            print("Failed to connect to the database. Exiting.")
+            return
+
+        # Fetch column names and types dynamically
+        async with pool.connection() as conn:
+            column_list = await get_table_columns(conn, args.schema, args.tablename)
+            if not column_list:
+                print(f"Table {args.schema}.{args.tablename} not found. Exiting.")
+                return
 
-    # Fetch column names and types dynamically
-    column_list = await get_table_columns(conn, args.schema, args.tablename)
+            # Initialize the DataGenerator with the column list
+            sfr = DataGenerator(column_list)
 
-    # Initialize the DataGenerator with the column list
-    sfr = DataGenerator(column_list)
+            # Render the INSERTs once for the whole run; every loader reuses the same query bytes. A batch too
+            # big for one statement is split into several, still sent together in the batch's transaction.
+            inserts = build_inserts(sfr, args.batchsize, conn)
 
-    start_time = time.time()
+        start_time = time.monotonic()
+        deadline = start_time + 10 * 60  # Stop loading after 10 minutes
 
-    loop = asyncio.get_event_loop()
-    tasks = [loop.create_task(loader(sfr, start_time)) for _ in range(int(args.threads))]
-    await asyncio.gather(*tasks)
+        reporter = asyncio.create_task(_reporter())
 
-    total_time = time.time() - start_time
-    print(f"Load test completed in {total_time / 60:.2f} minutes")
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(args.threads):
+                    tg.create_task(loader(pool, sfr, inserts, deadline))
+        finally:
+            reporter.cancel()  # Stop printing counters even if a loader failed
 
-    await conn.close()
+        total_time = time.monotonic() - start_time
+        print(f"Load test completed in {total_time / 60:.2f} minutes: {dict(_stats)}")
 
-async def loader(sfr, start_time):
-    """Perform bulk data loading serially using INSERT."""
-    conn = await connect_to_database()
-    if not conn:
-        print("Failed to connect to the database in loader. Exiting.")
-        return
+async def insert_batch(conn, inserts, params):
+    """Insert one batch in its own transaction, sending BEGIN, the INSERTs and COMMIT in a single round trip."""
+    cur = AsyncRawCursor(conn)
+    async with conn.pipeline() as p:
+        try:
+            for insert_query, start, end in inserts:
+                # Prepared on first use, so the server parses and plans each statement only once per connection
+                await cur.execute(insert_query, params[start:end], prepare=True)
+            await conn.commit()
+        except pgerr.Error:
+            # The server skips everything queued after a failed statement: collect those results as well, so
+            # the pipeline exits cleanly instead of warning that it was aborted
+            with contextlib.suppress(pgerr.Error):
+                await p.sync()
+            raise
 
-    cur = conn.cursor()
+async def loader(pool, sfr, inserts, deadline):
+    """Perform bulk data loading serially using multi-row INSERTs, one transaction per batch."""
+    # Generate the next batch in a worker thread while the current one is being inserted
+    next_batch = asyncio.create_task(asyncio.to_thread(sfr.get_n_rows, args.batchsize))
 
     while True:
         # Check if 10 minutes have passed
-        elapsed_time = time.time() - start_time
-        if elapsed_time >= 10 * 60:  # Stop after 10 minutes
+        if time.monotonic() >= deadline:
             break
 
-        # Get a batch of data
-        batch = await sfr.get_n_rows(args.batchsize)
-
-        for row in batch:
-            try:
-                # Use INSERT statement for each row
-                insert_cmd = sql.SQL("""
-                    INSERT INTO {} ({}) 
-                    VALUES ({})
-                    ON CONFLICT DO NOTHING
-                """).format(
-                    sql.Identifier(args.schema, args.tablename),
-                    sql.SQL(', ').join(map(sql.Identifier, [col[0] for col in sfr.column_list])),  # Column names
-                    sql.SQL(', ').join(sql.Placeholder() * len(row))  # Placeholders for values
-                )
-                await cur.execute(insert_cmd, row)  # Execute insert for each row
+        # Get a batch of data, and start generating the one after it
+        batch = await next_batch
+        next_batch = asyncio.create_task(asyncio.to_thread(sfr.get_n_rows, args.batchsize))
 
-            except Exception as e:
-                print(f"Error during insert: {e}")
-                break
+        try:
+            # Take a connection from the pool for each batch: the pool rolls back a failed batch, and replaces a
+            # lost connection with a new one instead of failing every batch after it
+            async with pool.connection() as conn:
+                # Flatten the batch to line up with the placeholders of the multi-row INSERTs
+                await insert_batch(conn, inserts, [value for row in batch for value in row])
+            _stats['batches'] += 1
+            _stats['rows_sent'] += len(batch)
 
-        await conn.commit()  # Commit after processing the batch
+        except Exception as e:
+            count_error(e, f"Error during insert: {e}")
 
-    await cur.close()
-    await conn.close()
+    next_batch.cancel()  # The test is over, the pre-generated batch won't be inserted
 
 def parse_args(in_args):
     global args
@@ -170,4 +293,5 @@ def parse_args(in_args):
     args = parser.parse_args(in_args)
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    # uvloop's libuv-based event loop has less overhead per socket read/write than the default asyncio loop
+    uvloop.run(main())